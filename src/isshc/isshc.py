@@ -1,37 +1,179 @@
+import codecs
 import logging
 import re
-import select
-from datetime import datetime
+import selectors
+import time
+from collections import OrderedDict
 from typing import Callable, Dict, Iterable, List, Optional, Self, Tuple
 
 from paramiko import Channel as _SSHChannel
 from paramiko import SSHClient
 from paramiko.config import SSH_PORT as _SSH_DEFAULT_PORT
 
+try:
+    import ahocorasick as _ahocorasick
+except ImportError:
+    _ahocorasick = None
+
 _logger = logging.getLogger(__name__)
 
+# Number of pattern sets whose matchers are kept for reuse per client
+_MATCHER_CACHE_SIZE = 32
+
+# Smallest number of bytes requested from the channel per receive
+_RECV_BATCH_NBYTES = 65536
+
+# Numbered backreferences and conditionals, which a combined regex would renumber
+_NUMBERED_GROUP_REF_RE = re.compile(r"\\[1-9]|\(\?\(\d")
+
+_REGEX_METACHARS = frozenset(".^$*+?{}[]\\|()")
+
+# Constructs that may match a newline, or make "$" match before one:
+# control characters, negated classes, inline flags, alternation,
+# and escapes other than punctuation and \d, \w, \S, \A, \B
+_NEWLINE_RISKY_RE = re.compile(r"[\x00-\x1f|]|\[\^|\(\?[aiLmsux-]|\\[^\W_dwSAB]")
+
+
+def _discard_text(text: str) -> None:
+    pass
+
+
+def _is_literal(pattern: str) -> bool:
+    return _REGEX_METACHARS.isdisjoint(pattern)
 
-def _wait_recv_ready(
-    channel: _SSHChannel,
-    timeout: Optional[float] = None,
-) -> bool:
-    (rlist, _, _) = select.select([channel], [], [], timeout)
-    # False on timeout
-    return bool(rlist)
 
+def _is_line_anchored(pattern: str) -> bool:
+    # True if every match is on the last line, i.e. the pattern ends
+    # with an unescaped "$" and cannot match a newline
+    if not pattern.endswith("$") or _NEWLINE_RISKY_RE.search(pattern):
+        return False
+    backslashes = len(pattern) - 1 - len(pattern[:-1].rstrip("\\"))
+    return backslashes % 2 == 0
 
-def _try_decode(data: bytearray, encoding: str) -> Optional[str]:
-    try:
-        return data.decode(encoding, "strict")
-    except UnicodeDecodeError:
-        return None
 
+class _PatternMatcher:
+    """
+    A set of patterns searched for in a single pass.
+
+    Literal patterns are searched with an Aho-Corasick automaton when
+    pyahocorasick is installed and there are several of them, and with
+    str.find() otherwise. The others are searched with a single alternation,
+    or one by one when they cannot be combined into one.
+    The leftmost match wins. Of matches at the same position, a literal
+    pattern wins over the others and a longer literal over a shorter one;
+    otherwise the pattern given first wins. An empty pattern never matches.
 
-def _find_pattern(patterns: Iterable[str], text: str) -> Optional[str]:
-    for pattern in patterns:
-        if re.search(pattern, text):
-            return pattern
-    return None
+    Attributes:
+        max_len (int):
+            Upper bound on the length of text matched by any pattern
+
+        patterns (Tuple[str, ...]):
+            Patterns in the order they were given
+
+        stripped (Tuple[str, ...]):
+            Patterns with surrounding whitespace removed, for logging
+    """
+
+    def __init__(self, patterns: Iterable[str], regex_match_len: int) -> None:
+        self.patterns: Tuple[str, ...] = tuple(patterns)
+        self.stripped: Tuple[str, ...] = tuple(p.strip() for p in self.patterns)
+        # regex_match_len is assumed for patterns that are not literal
+        self.max_len: int = max(
+            (len(p) if _is_literal(p) else regex_match_len for p in self.patterns),
+            default=0,
+        )
+        self._line_anchored = bool(self.patterns) and all(
+            _is_line_anchored(p) for p in self.patterns
+        )
+        # Indices of patterns by rank: literals, the longest first, then the
+        # others, each in the order given
+        self._ranked: Tuple[int, ...] = tuple(
+            sorted(
+                range(len(self.patterns)),
+                key=lambda i: -len(self.patterns[i]) if _is_literal(self.patterns[i]) else 0,
+            )
+        )
+        ranked = [self.patterns[i] for i in self._ranked]
+        # Empty patterns are dropped, as they never count as a match
+        literal_ranks = [r for (r, p) in enumerate(ranked) if p and _is_literal(p)]
+        regex_ranks = [r for (r, p) in enumerate(ranked) if p and not _is_literal(p)]
+        self._automaton = None
+        self._literal_max_len = 0
+        self._literals: List[Tuple[str, int]] = []
+        if literal_ranks:
+            if _ahocorasick is None or len(literal_ranks) == 1:
+                self._literals = [(ranked[r], r) for r in literal_ranks]
+            else:
+                self._automaton = _ahocorasick.Automaton()
+                for r in literal_ranks:
+                    # The first of duplicate patterns wins, as in an alternation
+                    if not self._automaton.exists(ranked[r]):
+                        self._automaton.add_word(ranked[r], (r, len(ranked[r])))
+                self._automaton.make_automaton()
+                self._literal_max_len = max(len(ranked[r]) for r in literal_ranks)
+        # Compiled on their own first, so that an invalid pattern raises re.error
+        # instead of breaking out of its group in the alternation
+        regexes = [(re.compile(ranked[r]), r) for r in regex_ranks]
+        self._regex: Optional[re.Pattern] = None
+        self._regexes: List[Tuple[re.Pattern, int]] = []
+        if regex_ranks and not any(_NUMBERED_GROUP_REF_RE.search(ranked[r]) for r in regex_ranks):
+            try:
+                # An alternation tries its branches in order, so they follow the ranks
+                self._regex = re.compile("|".join(f"(?P<_p{r}>{ranked[r]})" for r in regex_ranks))
+            except re.error:
+                pass
+        if self._regex is None:
+            # Patterns that cannot share one expression, e.g. with inline flags,
+            # backreferences or the same group names, are searched one by one
+            self._regexes = regexes
+
+    def search(self, text: str, pos: int = 0) -> Optional[int]:
+        """
+        Find the leftmost occurrence of any pattern in text.
+
+        Args:
+            text (str):
+                Text to search
+
+            pos (int):
+                Index in text where the search starts
+
+        Returns:
+            Optional[int]: Index of the matched pattern, or None if nothing matched
+        """
+        if self._line_anchored:
+            # Skip to the last line, ignoring a trailing newline "$" can precede
+            pos = text.rfind("\n", pos, len(text) - 1) + 1 or pos
+        # (start, rank) of the leftmost match, the best ranked pattern winning ties
+        found: Optional[Tuple[int, int]] = None
+        for literal, rank in self._literals:
+            # Only a match starting before the one found can win
+            end = len(text) if found is None else found[0] + len(literal) - 1
+            start = text.find(literal, pos, end)
+            if start >= 0:
+                found = (start, rank)
+        if self._automaton is not None:
+            for end, (rank, length) in self._automaton.iter(text, pos):
+                # No later match can start before the one found
+                if found is not None and end - self._literal_max_len >= found[0]:
+                    break
+                candidate = (end - length + 1, rank)
+                if found is None or candidate < found:
+                    found = candidate
+        if self._regex is not None:
+            match = self._regex.search(text, pos)
+            if match is not None:
+                assert match.lastgroup is not None
+                candidate = (match.start(), int(match.lastgroup[2:]))
+                if found is None or candidate < found:
+                    found = candidate
+        for regex, rank in self._regexes:
+            match = regex.search(text, pos)
+            if match is not None:
+                candidate = (match.start(), rank)
+                if found is None or candidate < found:
+                    found = candidate
+        return None if found is None else self._ranked[found[1]]
 
 
 class InteractiveSSHClient:
@@ -51,9 +193,14 @@ class InteractiveSSHClient:
         prompts (Optional[List[str]]):
             List of prompt patterns
 
+        recv_max_match_len (int):
+            Maximum number of characters a match of a non-literal pattern
+            is assumed to span, when searching text received in several
+            parts (default is 256)
+
         recv_nbytes (int):
-            Number of bytes of data to receive at one time
-            (default is 1024)
+            Minimum number of bytes of data to receive at one time
+            (default is 1024, raised to 65536 when smaller)
 
         recv_timeout (float):
             Maximum number of seconds to wait for a pattern to appear
@@ -72,8 +219,13 @@ class InteractiveSSHClient:
         self.encoding: str = "utf-8"
         self.on_recv_partial_text: Optional[Callable[[str], None]] = None
         self.prompts: Optional[List[str]] = None
+        self.recv_max_match_len: int = 256
         self.recv_nbytes: int = 1024
         self.recv_timeout: float = 30.0
+        self._decoder: Optional[codecs.IncrementalDecoder] = None
+        self._decoder_encoding: str = self.encoding
+        self._matchers: OrderedDict[Tuple[int, Tuple[str, ...]], _PatternMatcher] = OrderedDict()
+        self._selector: Optional[selectors.BaseSelector] = None
         self._session: Optional[_SSHChannel] = None
         self._sshc: SSHClient = SSHClient()
 
@@ -92,12 +244,28 @@ class InteractiveSSHClient:
         _logger.info("Connection closed.")
 
     def _close_session(self) -> None:
+        self._decoder = None
+        if self._selector:
+            self._selector.close()
+            self._selector = None
         if self._session:
             if not self._session.closed:
                 self._session.close()
                 _logger.info("Interactive shell terminated.")
             self._session = None
 
+    def _get_matcher(self, patterns: Iterable[str]) -> _PatternMatcher:
+        # Keyed in order, since the order of patterns breaks ties
+        key = (self.recv_max_match_len, tuple(patterns))
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            matcher = self._matchers[key] = _PatternMatcher(key[1], self.recv_max_match_len)
+            if len(self._matchers) > _MATCHER_CACHE_SIZE:
+                self._matchers.popitem(last=False)
+        else:
+            self._matchers.move_to_end(key)
+        return matcher
+
     def _open_connection(self, hostname: str, **kwargs) -> None:
         try:
             port = kwargs.get("port", _SSH_DEFAULT_PORT)
@@ -116,6 +284,10 @@ class InteractiveSSHClient:
             self._session = transport.open_session()
             self._session.get_pty()
             self._session.invoke_shell()
+            # Registered once and polled for every receive
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._session, selectors.EVENT_READ)
+            self._reset_decoder()
             _logger.info("Successfully opened an interactive shell.")
         except Exception:
             _logger.exception("Failed to open an interactive shell.")
@@ -123,6 +295,13 @@ class InteractiveSSHClient:
             self._close_connection()
             raise
 
+    def _reset_decoder(self) -> codecs.IncrementalDecoder:
+        # Kept for the session, so that a multibyte character split between
+        # two recv_text() calls is decoded whole
+        self._decoder = codecs.getincrementaldecoder(self.encoding)("strict")
+        self._decoder_encoding = self.encoding
+        return self._decoder
+
     def close_shell(self) -> None:
         """
         Terminate the interactive shell and close the connection.
@@ -147,6 +326,15 @@ class InteractiveSSHClient:
         """
         Receive text from the interactive shell.
 
+        The pattern matching earliest in the text is taken. Of patterns
+        matching at the same position, a literal one (without regex special
+        characters) is taken over the others and a longer literal one over
+        a shorter one; otherwise the pattern given first is taken.
+
+        Text is searched as it arrives, so a match of a non-literal pattern
+        spanning more than recv_max_match_len characters can be missed when
+        the text is received in several parts.
+
         Args:
             auto_replies (Dict[str, str]):
                 Dictionary of auto-reply patterns and texts
@@ -160,8 +348,10 @@ class InteractiveSSHClient:
 
         Raises:
             ValueError:
-                Timeout must be greater than 0.
+                Timeout or recv_max_match_len is not greater than 0.
         """
+        if self.recv_max_match_len <= 0:
+            raise ValueError("recv_max_match_len must be greater than 0.")
         if self.recv_nbytes <= 0:
             raise ValueError("recv_nbytes must be greater than 0.")
         if self.recv_timeout <= 0:
@@ -170,56 +360,109 @@ class InteractiveSSHClient:
             auto_replies = self.auto_replies or {}
         if prompts is None:
             prompts = self.prompts or []
-
-        wait_start_time = datetime.now()
-        recv_buffer = bytearray()
-        text_buffer = ""
-        text_archived = ""
+        reply_matcher = self._get_matcher(auto_replies.keys())
+        reply_texts = tuple(auto_replies.values())
+        prompt_matcher = self._get_matcher(prompts)
+        # Tail kept between chunks: the longest overlap a match can need, plus one
+        # character so that a trimmed tail never looks like the start of text to ^ or \b
+        tail_len = max(reply_matcher.max_len, prompt_matcher.max_len)
+
+        session = self._session
+        selector = self._selector
+        if session is None or selector is None:
+            _logger.warning("Connection closed while receiving text.")
+            return "", None
+
+        # Bound once, as attribute lookups add up in the receive loop
+        recv = session.recv
+        wait_recv_ready = selector.select
+        recv_nbytes = max(self.recv_nbytes, _RECV_BATCH_NBYTES)
+        recv_timeout = self.recv_timeout
+        # A no-op handler is cheaper than testing for None on every chunk
+        on_recv_partial_text = self.on_recv_partial_text or _discard_text
+        monotonic = time.monotonic
+        reply_search = reply_matcher.search
+        reply_max_len = reply_matcher.max_len
+        has_replies = bool(reply_matcher.patterns)
+        prompt_search = prompt_matcher.search
+        prompt_max_len = prompt_matcher.max_len
+        has_prompts = bool(prompt_matcher.patterns)
+
+        decoder = self._decoder
+        if decoder is None or self._decoder_encoding != self.encoding:
+            decoder = self._reset_decoder()
+        decode = decoder.decode
+
+        deadline = monotonic() + recv_timeout
+        # Received data kept undecoded from the first decoding error on
+        undecoded: List[bytes] = []
+        # All text received, joined once on return
+        text_chunks: List[str] = []
+        # End of the text since the last auto-reply, already searched without a match
+        search_tail = ""
         while True:
-            if self._session is None or self._session.closed:
+            if session.closed:
                 _logger.warning("Connection closed while receiving text.")
-                text_archived += text_buffer
                 break
 
-            elapsed = (datetime.now() - wait_start_time).total_seconds()
-            timeout_remaining = max(0, self.recv_timeout - elapsed)
-            if not _wait_recv_ready(self._session, timeout_remaining):
+            # Empty on timeout; does not block once the timeout is not positive
+            if not wait_recv_ready(deadline - monotonic()):
                 _logger.warning("Timeout reached while waiting for prompt.")
-                text_archived += text_buffer
                 break
 
-            while self._session.recv_ready():
-                recv_buffer.extend(self._session.recv(self.recv_nbytes))
-            decoded = _try_decode(recv_buffer, self.encoding)
-            if decoded is None:
+            # Returns whatever is buffered, up to the requested size
+            data = recv(recv_nbytes)
+            if undecoded:
+                undecoded.append(data)
+                continue
+            try:
+                decoded = decode(data)
+            except UnicodeDecodeError:
+                undecoded.append(data)
+                continue
+            # Empty while a multibyte character is incomplete
+            if not decoded:
                 continue
-            if self.on_recv_partial_text:
-                self.on_recv_partial_text(decoded)
-            text_buffer += decoded
-            recv_buffer.clear()
+            on_recv_partial_text(decoded)
+            text_chunks.append(decoded)
+            if tail_len == 0:
+                continue
+            search_text = search_tail + decoded
 
-            if auto_reply := _find_pattern(auto_replies.keys(), text_buffer):
-                reply_text = auto_replies[auto_reply]
+            reply_index = None
+            if has_replies:
+                reply_index = reply_search(
+                    search_text, max(len(search_tail) - reply_max_len + 1, 0)
+                )
+            if reply_index is not None:
+                reply_text = reply_texts[reply_index]
                 _logger.debug(
-                    f"Found auto-reply pattern: {auto_reply.strip()}"
+                    f"Found auto-reply pattern: {reply_matcher.stripped[reply_index]}"
                     + f" -> Sending: {reply_text.strip()}"
                 )
                 self.send_text(reply_text)
-                wait_start_time = datetime.now()
-                text_archived += text_buffer
-                text_buffer = ""
+                deadline = monotonic() + recv_timeout
+                search_tail = ""
                 continue
 
-            if prompt := _find_pattern(prompts, text_buffer):
-                _logger.debug(f"Found prompt pattern: {prompt.strip()}")
-                return text_archived + text_buffer, prompt
-
-        text_broken = ""
-        if recv_buffer:
-            text_broken = recv_buffer.decode(self.encoding, "replace")
-            if self.on_recv_partial_text:
-                self.on_recv_partial_text(text_broken)
-        return text_archived + text_buffer + text_broken, None
+            prompt_index = None
+            if has_prompts:
+                prompt_index = prompt_search(
+                    search_text, max(len(search_tail) - prompt_max_len + 1, 0)
+                )
+            if prompt_index is not None:
+                _logger.debug(f"Found prompt pattern: {prompt_matcher.stripped[prompt_index]}")
+                prompt = prompt_matcher.patterns[prompt_index]
+                return "".join(text_chunks), prompt
+            search_tail = search_text[-tail_len:]
+
+        decoder.errors = "replace"
+        text_broken = decoder.decode(b"".join(undecoded), final=True)
+        decoder.errors = "strict"
+        if text_broken:
+            on_recv_partial_text(text_broken)
+            text_chunks.append(text_broken)
+        return "".join(text_chunks), None
 
     def send_text(self, text: str) -> int:
         """
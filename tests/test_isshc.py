@@ -1,45 +1,156 @@
 import logging
+import re
+import selectors
 from unittest.mock import MagicMock, patch
 
 import pytest
 
 from isshc import InteractiveSSHClient
-from isshc.isshc import _find_pattern, _try_decode, _wait_recv_ready
+from isshc.isshc import _MATCHER_CACHE_SIZE, _is_line_anchored, _PatternMatcher
 
 
-# --- Test for _wait_recv_ready() --- #
-@patch("isshc.select.select", return_value=(["dummy"], [], []))
-def test_wait_recv_ready_true(mock_select):
-    channel = MagicMock()
-    channel.closed = False
-    channel.fileno.return_value = 1
-    assert _wait_recv_ready(channel) is True
+# --- Test for _is_line_anchored() --- #
+def test_is_line_anchored_true():
+    assert _is_line_anchored(r"\[\w+@\w+\]\$ $")
+    assert _is_line_anchored(r"prompt\\$")
 
 
-@patch("isshc.select.select", return_value=([], [], []))
-def test_wait_recv_ready_false(mock_select):
-    channel = MagicMock()
-    channel.closed = False
-    channel.fileno.return_value = 1
-    assert _wait_recv_ready(channel) is False
+def test_is_line_anchored_false():
+    assert not _is_line_anchored(r"prompt\$")
+    assert not _is_line_anchored("prompt>")
+    assert not _is_line_anchored(r"\$\s*$")
+    assert not _is_line_anchored(r"[^>]>$")
+    assert not _is_line_anchored(r"(?m)>$")
+    assert not _is_line_anchored(r"a|b$")
 
 
-# --- Test for _try_decode() --- #
-def test_try_decode_success():
-    assert _try_decode(bytearray(b"hello"), "utf-8") == "hello"
+# --- Test for _PatternMatcher --- #
+def test_pattern_matcher_match():
+    assert _PatternMatcher(["world", "test"], 256).search("hello world") == 0
 
 
-def test_try_decode_failure():
-    assert _try_decode(bytearray(b"\xff\xff"), "utf-8") is None
+def test_pattern_matcher_no_match():
+    assert _PatternMatcher(["abc", "def"], 256).search("hello world") is None
 
 
-# --- Test for _find_pattern() --- #
-def test_find_pattern_match():
-    assert _find_pattern(["world", "test"], "hello world") == "world"
+def test_pattern_matcher_leftmost():
+    assert _PatternMatcher([r"w\w+", "h.l"], 256).search("hello world") == 1
 
 
-def test_find_pattern_no_match():
-    assert _find_pattern(["abc", "def"], "hello world") is None
+def test_pattern_matcher_inline_flags():
+    assert _PatternMatcher([r"(?i)password:", r"\$ $"], 256).search("PASSWORD: ") == 0
+    assert _PatternMatcher([r"\$ $", r"(?i)password:"], 256).search("PASSWORD: ") == 1
+
+
+def test_pattern_matcher_backreference():
+    assert _PatternMatcher([r"(\w)\1>"], 256).search("ab aa>") == 0
+    assert _PatternMatcher([r"x(y)z", r"(\w)\1>"], 256).search("ab aa>") == 1
+
+
+def test_pattern_matcher_duplicate_group_names():
+    matcher = _PatternMatcher([r"(?P<u>\w+)@a", r"(?P<u>\w+)@bb"], 256)
+    assert matcher.search("me@bb") == 1
+    assert _PatternMatcher([r"z+", r"(?P<_p0>x)y"], 256).search("xy") == 1
+
+
+def test_pattern_matcher_empty():
+    assert _PatternMatcher([], 256).search("hello world") is None
+
+
+def test_pattern_matcher_tie():
+    assert _PatternMatcher(["ab", "abc"], 256).search("xabc") == 1
+    assert _PatternMatcher([r"a.", "abc"], 256).search("xabc") == 1
+    assert _PatternMatcher([r"[Pp]assword:", "Password:"], 256).search("Password:") == 1
+    assert _PatternMatcher([r"\$ ", r"\$\s"], 256).search("$ ") == 0
+    assert _PatternMatcher([r"\$\s", r"\$ "], 256).search("$ ") == 0
+    assert _PatternMatcher([r"a\w", r"a\w+"], 256).search("xabc") == 0
+    assert _PatternMatcher([r"a\w+", r"a\w"], 256).search("xabc") == 0
+    assert _PatternMatcher(["ab", "ab"], 256).search("xabc") == 0
+
+
+def test_pattern_matcher_literal_leftmost():
+    assert _PatternMatcher(["b", "abc"], 256).search("xabc") == 1
+    assert _PatternMatcher(["ab", "ab"], 256).search("xabc") == 0
+
+
+def test_pattern_matcher_mixed_leftmost():
+    assert _PatternMatcher(["world", r"l+o"], 256).search("hello world") == 1
+    assert _PatternMatcher([r"w\w+", "hello"], 256).search("hello world") == 1
+
+
+def test_pattern_matcher_invalid_pattern():
+    with pytest.raises(re.error):
+        _PatternMatcher(["a)|(b"], 256)
+    with pytest.raises(re.error):
+        _PatternMatcher(["prompt>", "a)|(?P<_p1>b"], 256)
+
+
+def test_pattern_matcher_empty_pattern():
+    assert _PatternMatcher([""], 256).search("abc") is None
+    matcher = _PatternMatcher(["", "x>"], 256)
+    assert matcher.search("abc") is None
+    assert matcher.search("abc x>") == 1
+
+
+def test_pattern_matcher_single_literal():
+    matcher = _PatternMatcher(["prompt>"], 256)
+    assert matcher._automaton is None
+    assert matcher._regex is None
+    assert matcher.search("prompt> prompt>", 1) == 0
+    assert matcher.search("prompt> prompt", 1) is None
+
+
+@patch("isshc.isshc._ahocorasick", None)
+def test_pattern_matcher_without_ahocorasick():
+    assert _PatternMatcher(["b", "abc"], 256).search("xabc") == 1
+    assert _PatternMatcher(["lo", "hel", "he"], 256).search("hello") == 1
+    assert _PatternMatcher(["world", r"l+o"], 256).search("hello world") == 1
+
+
+def test_pattern_matcher_line_anchored():
+    matcher = _PatternMatcher([r"\w+> $", r"\$ $"], 256)
+    assert matcher.search("a> \nb$ ") == 1
+    assert matcher.search("a> \nb$ \n") == 1
+    assert matcher.search("a> \nb\n") is None
+    assert matcher.search("a> ") == 0
+
+
+def test_pattern_matcher_pos():
+    assert _PatternMatcher(["hello"], 256).search("hello world", 1) is None
+
+
+def test_pattern_matcher_stripped():
+    assert _PatternMatcher(["Password: ", r"\$ $"], 256).stripped == ("Password:", r"\$ $")
+
+
+def test_pattern_matcher_max_len():
+    assert _PatternMatcher(["abc", "Password:"], 256).max_len == 9
+    assert _PatternMatcher(["abc", r"\$ $"], 256).max_len == 256
+    assert _PatternMatcher(["abc", r"\$ $"], 2).max_len == 3
+    assert _PatternMatcher([], 256).max_len == 0
+
+
+# --- Test for InteractiveSSHClient._get_matcher() --- #
+def test_get_matcher_cached():
+    with InteractiveSSHClient() as client:
+        matcher = client._get_matcher(["a", "b"])
+        assert client._get_matcher(["a", "b"]) is matcher
+        assert client._get_matcher(["b", "a"]) is not matcher
+        client.recv_max_match_len = 1000
+        assert client._get_matcher(["a", "b"]) is not matcher
+
+
+def test_get_matcher_evicts_least_recently_used():
+    with InteractiveSSHClient() as client:
+        first = client._get_matcher(["first"])
+        second = client._get_matcher(["second"])
+        for i in range(_MATCHER_CACHE_SIZE - 2):
+            client._get_matcher([str(i)])
+        assert client._get_matcher(["first"]) is first
+        client._get_matcher(["last"])
+        assert len(client._matchers) == _MATCHER_CACHE_SIZE
+        assert client._get_matcher(["first"]) is first
+        assert client._get_matcher(["second"]) is not second
 
 
 # --- Test for InteractiveSSHClient._close_session() --- #
@@ -48,12 +159,17 @@ def test_close_session_when_not_closed(caplog):
         mock_session = MagicMock()
         mock_session.closed = False
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client._decoder = MagicMock()
 
         with caplog.at_level(logging.INFO):
             client._close_session()
 
         assert client._session is None
+        assert client._selector is None
+        assert client._decoder is None
         mock_session.close.assert_called_once()
+        mock_selector.close.assert_called_once()
         assert "Interactive shell terminated." in caplog.text
 
 
@@ -86,8 +202,9 @@ def test_open_connection_failure(mock_connect):
 
 
 # --- Test for InteractiveSSHClient._open_session() --- #
+@patch("isshc.isshc.selectors.DefaultSelector")
 @patch("paramiko.SSHClient.get_transport")
-def test_open_session_success(mock_transport):
+def test_open_session_success(mock_transport, mock_selector_class):
     mock_session = MagicMock()
     mock_transport.return_value.open_session.return_value = mock_session
 
@@ -97,8 +214,11 @@ def test_open_session_success(mock_transport):
         client._open_session()
 
         assert client._session == mock_session
+        assert client._selector == mock_selector_class.return_value
         mock_session.get_pty.assert_called_once()
         mock_session.invoke_shell.assert_called_once()
+        client._selector.register.assert_called_once_with(mock_session, selectors.EVENT_READ)
+        assert client._decoder is not None
 
 
 @patch("paramiko.SSHClient.get_transport", return_value=None)
@@ -143,19 +263,19 @@ def test_open_shell_success(mock_open_session, mock_open_conn):
 
 
 # --- Test for InteractiveSSHClient.recv_text() --- #
-@patch("isshc.select.select")
-def test_recv_text_success(mock_select):
+def test_recv_text_success():
     with InteractiveSSHClient() as client:
         mock_session = MagicMock()
         mock_session.closed = False
         mock_session.fileno.return_value = 1
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
         client.prompts = ["prompt>"]
 
         state = {"step": "0_WAIT_FOR_PROMPT_PATTERN"}
 
-        def fake_select(rlist, _, __, timeout=None):
-            return ([mock_session], [], []) if fake_recv_ready() else ([], [], [])
+        def fake_select(timeout=None):
+            return [(MagicMock(), selectors.EVENT_READ)] if fake_recv_ready() else []
 
         def fake_recv_ready():
             match state["step"]:
@@ -174,7 +294,7 @@ def test_recv_text_success(mock_select):
 
         mock_session.recv_ready.side_effect = fake_recv_ready
         mock_session.recv.side_effect = fake_recv
-        mock_select.side_effect = fake_select
+        mock_selector.select.side_effect = fake_select
 
         text, pattern = client.recv_text()
 
@@ -183,26 +303,202 @@ def test_recv_text_success(mock_select):
         assert state["step"] == "1_NO_MORE_DATA"
 
 
-@patch("isshc.select.select", return_value=([], [], []))
-def test_recv_text_session_closed(mock_select):
+def _feed_chunks(mock_session, mock_selector, chunks):
+    def fake_select(timeout=None):
+        return [(MagicMock(), selectors.EVENT_READ)] if chunks else []
+
+    def fake_recv(_):
+        return chunks.pop(0)
+
+    mock_session.recv.side_effect = fake_recv
+    mock_selector.select.side_effect = fake_select
+
+
+def test_recv_text_prompt_split_across_chunks():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"some output pro", b"mpt>"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "some output prompt>"
+        assert pattern == "prompt>"
+
+
+def test_recv_text_recv_nbytes():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"prompt>", b"prompt>"])
+
+        client.recv_text()
+        mock_session.recv.assert_called_once_with(65536)
+
+        client.recv_nbytes = 100000
+        client.recv_text()
+        mock_session.recv.assert_called_with(100000)
+
+
+def test_recv_text_long_regex_match_split_across_chunks():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = [r"BEGIN[\s\S]*END"]
+        client.recv_max_match_len = 1000
+        _feed_chunks(mock_session, mock_selector, [b"BEGIN", b"x" * 300, b"END"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "BEGIN" + "x" * 300 + "END"
+        assert pattern == r"BEGIN[\s\S]*END"
+
+
+def test_recv_text_timeout_returns_text_once():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.send_text = MagicMock()
+        client.prompts = ["prompt>"]
+        client.auto_replies = {"Password:": "yes\n"}
+        _feed_chunks(mock_session, mock_selector, [b"Password:", b"output"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "Password:output"
+        assert pattern is None
+        client.send_text.assert_called_once_with("yes\n")
+
+
+def test_recv_text_connection_closed_returns_text_once():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["prompt>"]
+
+        def fake_recv(_):
+            mock_session.closed = True
+            return b"output"
+
+        mock_session.recv.side_effect = fake_recv
+        mock_selector.select.return_value = [(MagicMock(), selectors.EVENT_READ)]
+
+        text, pattern = client.recv_text()
+
+        assert text == "output"
+        assert pattern is None
+
+
+def test_recv_text_multibyte_split_across_chunks():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"\xe3\x81", b"\x82prompt>"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "\u3042prompt>"
+        assert pattern == "prompt>"
+
+
+def test_recv_text_incomplete_multibyte_at_timeout():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"abc\xe3\x81"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "abc\ufffd"
+        assert pattern is None
+
+
+def test_recv_text_multibyte_split_across_calls():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["done>", "prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"done> \xe3\x81", b"\x82 more prompt>"])
+
+        assert client.recv_text() == ("done> ", "done>")
+        assert client.recv_text() == ("\u3042 more prompt>", "prompt>")
+
+
+def test_recv_text_anchor_not_matched_after_trimmed_text():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = ["^prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"x" * 300, b"prompt>"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "x" * 300 + "prompt>"
+        assert pattern is None
+
+
+def test_recv_text_session_closed():
     with InteractiveSSHClient() as client:
         mock_session = MagicMock()
         mock_session.closed = True
         mock_session.fileno.return_value = 1
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        mock_selector.select.return_value = []
         client.prompts = ["prompt>"]
         text, pattern = client.recv_text()
         assert text == ""
         assert pattern is None
 
 
-@patch("isshc.select.select")
-def test_recv_text_prompt_and_reply(mock_select):
+def test_recv_text_not_connected(caplog):
+    with InteractiveSSHClient() as client:
+        client.prompts = ["prompt>"]
+        with caplog.at_level(logging.WARNING):
+            text, pattern = client.recv_text()
+        assert text == ""
+        assert pattern is None
+        assert "Connection closed while receiving text." in caplog.text
+
+
+def test_recv_text_prompt_and_reply():
     with InteractiveSSHClient() as client:
         mock_session = MagicMock()
         mock_session.closed = False
         mock_session.fileno.return_value = 1
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
         client.prompts = ["prompt>"]
         client.auto_replies = {"Password:": "yes\n"}
 
@@ -218,8 +514,8 @@ def test_recv_text_prompt_and_reply(mock_select):
 
         client.send_text = MagicMock(side_effect=mock_send_text)
 
-        def fake_select(rlist, _, __, timeout=None):
-            return ([mock_session], [], []) if fake_recv_ready() else ([], [], [])
+        def fake_select(timeout=None):
+            return [(MagicMock(), selectors.EVENT_READ)] if fake_recv_ready() else []
 
         def fake_recv_ready():
             match state["step"]:
@@ -229,7 +525,7 @@ def test_recv_text_prompt_and_reply(mock_select):
                     return True
                 case "3_WAIT_FOR_DATA":
                     state["step"] = "4_WAIT_FOR_PROMPT_PATTERN"
-                    return False
+                    return True
                 case "4_WAIT_FOR_PROMPT_PATTERN":
                     return True
                 case _:
@@ -256,24 +552,25 @@ def test_recv_text_prompt_and_reply(mock_select):
 
         mock_session.recv_ready.side_effect = fake_recv_ready
         mock_session.recv.side_effect = fake_recv
-        mock_select.side_effect = fake_select
+        mock_selector.select.side_effect = fake_select
 
         text, pattern = client.recv_text()
 
-        assert "prompt>" in text
+        assert text == "Password:dummy text not including any patternsprompt>"
         assert pattern == "prompt>"
         assert state["step"] == "5_NO_MORE_DATA"
         assert state["recv_count"] > 0
         client.send_text.assert_called_once_with("yes\n")
 
 
-@patch("isshc.select.select", return_value=([], [], []))
-def test_recv_text_wait_recv_ready_timeout(mock_select, caplog):
+def test_recv_text_wait_recv_ready_timeout(caplog):
     with InteractiveSSHClient() as client:
         mock_session = MagicMock()
         mock_session.closed = False
         mock_session.fileno.return_value = 1
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        mock_selector.select.return_value = []
 
         with caplog.at_level(logging.WARNING):
             text, pattern = client.recv_text()
@@ -281,15 +578,17 @@ def test_recv_text_wait_recv_ready_timeout(mock_select, caplog):
         assert text == ""
         assert pattern is None
         assert "Timeout reached while waiting for prompt." in caplog.text
+        (timeout,), _ = mock_selector.select.call_args
+        assert 0 < timeout <= client.recv_timeout
 
 
-@patch("isshc.select.select")
-def test_recv_text_decode_fails(mock_select):
+def test_recv_text_decode_fails():
     with InteractiveSSHClient() as client:
         mock_session = MagicMock()
         mock_session.closed = False
         mock_session.fileno.return_value = 1
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
         client.prompts = ["prompt>"]
 
         state = {
@@ -297,10 +596,10 @@ def test_recv_text_decode_fails(mock_select):
             "recv_count": 0,
         }
 
-        def fake_select(rlist, _, __, timeout=None):
+        def fake_select(timeout=None):
             if state["retry"] < 2:
-                return ([mock_session], [], [])
-            return ([], [], [])
+                return [(MagicMock(), selectors.EVENT_READ)]
+            return []
 
         def fake_recv_ready():
             return state["retry"] < 2
@@ -316,7 +615,7 @@ def test_recv_text_decode_fails(mock_select):
 
         mock_session.recv_ready.side_effect = fake_recv_ready
         mock_session.recv.side_effect = fake_recv
-        mock_select.side_effect = fake_select
+        mock_selector.select.side_effect = fake_select
 
         text, pattern = client.recv_text()
 
@@ -326,20 +625,20 @@ def test_recv_text_decode_fails(mock_select):
         assert state["recv_count"] == 1
 
 
-@patch("isshc.select.select")
-def test_recv_text_decode_fails_without_handler(mock_select):
+def test_recv_text_decode_fails_without_handler():
     with InteractiveSSHClient() as client:
         mock_session = MagicMock()
         mock_session.closed = False
         mock_session.fileno.return_value = 1
         client._session = mock_session
+        client._selector = mock_selector = MagicMock()
 
         state = {"retry": 0}
 
-        def fake_select(rlist, _, __, timeout=None):
+        def fake_select(timeout=None):
             if state["retry"] < 2:
-                return ([mock_session], [], [])
-            return ([], [], [])
+                return [(MagicMock(), selectors.EVENT_READ)]
+            return []
 
         def fake_recv_ready():
             return state["retry"] < 2
@@ -350,7 +649,7 @@ def test_recv_text_decode_fails_without_handler(mock_select):
 
         mock_session.recv_ready.side_effect = fake_recv_ready
         mock_session.recv.side_effect = fake_recv
-        mock_select.side_effect = fake_select
+        mock_selector.select.side_effect = fake_select
 
         text, pattern = client.recv_text(prompts=["prompt>"], auto_replies={})
 
@@ -359,6 +658,22 @@ def test_recv_text_decode_fails_without_handler(mock_select):
         assert state["retry"] == 2
 
 
+def test_recv_text_inline_flag_pattern():
+    with InteractiveSSHClient() as client:
+        mock_session = MagicMock()
+        mock_session.closed = False
+        mock_session.fileno.return_value = 1
+        client._session = mock_session
+        client._selector = mock_selector = MagicMock()
+        client.prompts = [r"\$ $", r"(?i)prompt>"]
+        _feed_chunks(mock_session, mock_selector, [b"PROMPT>"])
+
+        text, pattern = client.recv_text()
+
+        assert text == "PROMPT>"
+        assert pattern == r"(?i)prompt>"
+
+
 def test_recv_text_invalid_nbytes():
     with InteractiveSSHClient() as client:
         client.prompts = ["a"]
@@ -367,6 +682,14 @@ def test_recv_text_invalid_nbytes():
             client.recv_text()
 
 
+def test_recv_text_invalid_max_match_len():
+    with InteractiveSSHClient() as client:
+        client.prompts = ["a"]
+        client.recv_max_match_len = 0
+        with pytest.raises(ValueError):
+            client.recv_text()
+
+
 def test_recv_text_invalid_timeout():
     with InteractiveSSHClient() as client:
         client.prompts = ["a"]